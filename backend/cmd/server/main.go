@@ -172,6 +172,7 @@ func main() {
 		// ESP Device routes (token auth)
 		esp := v1.Group("")
 		esp.Use(middleware.DeviceAuthMiddleware(db))
+		esp.Use(middleware.GzipRequestMiddleware())
 		{
 			esp.POST("/metrics", deviceHandler.ReceiveMetrics)
 			esp.POST("/metrics/batch", gatewayHandler.ReceiveBatchMetrics)
@@ -6,6 +6,7 @@ import (
 	"time"
 
 	"github.com/google/uuid"
+	"github.com/jackc/pgx/v5"
 	"github.com/pfaka/iot-dashboard/internal/models"
 )
 
@@ -14,16 +15,73 @@ func (db *DB) CreateMetric(ctx context.Context, metric *models.Metric) error {
 	meshNodesJSON, _ := json.Marshal(metric.MeshNodes)
 
 	query := `
-		INSERT INTO metrics (device_id, temperature, humidity, rssi, free_heap, wifi_scan, mesh_nodes)
-		VALUES ($1, $2, $3, $4, $5, $6, $7)
+		INSERT INTO metrics (device_id, temperature, humidity, rssi, free_heap, wifi_scan, mesh_nodes, created_at)
+		VALUES ($1, $2, $3, $4, $5, $6, $7, COALESCE($8, NOW()))
 		RETURNING id, created_at
 	`
 	return db.Pool.QueryRow(ctx, query,
 		metric.DeviceID, metric.Temperature, metric.Humidity, metric.RSSI,
-		metric.FreeHeap, wifiScanJSON, meshNodesJSON,
+		metric.FreeHeap, wifiScanJSON, meshNodesJSON, recordedAt(metric),
 	).Scan(&metric.ID, &metric.CreatedAt)
 }
 
+// recordedAt returns the metric's own timestamp, or nil to let the database
+// stamp it with NOW()
+func recordedAt(metric *models.Metric) *time.Time {
+	if metric.CreatedAt.IsZero() {
+		return nil
+	}
+	return &metric.CreatedAt
+}
+
+// CreateMetrics inserts several metrics in a single round trip.
+// If the batch fails, it falls back to one insert per metric so a single bad
+// row does not drop the rest.
+func (db *DB) CreateMetrics(ctx context.Context, metrics []*models.Metric) error {
+	if len(metrics) == 0 {
+		return nil
+	}
+
+	query := `
+		INSERT INTO metrics (device_id, temperature, humidity, rssi, free_heap, wifi_scan, mesh_nodes, created_at)
+		VALUES ($1, $2, $3, $4, $5, $6, $7, COALESCE($8, NOW()))
+		RETURNING id, created_at
+	`
+	batch := &pgx.Batch{}
+	for _, metric := range metrics {
+		wifiScanJSON, _ := json.Marshal(metric.WifiScan)
+		meshNodesJSON, _ := json.Marshal(metric.MeshNodes)
+		batch.Queue(query,
+			metric.DeviceID, metric.Temperature, metric.Humidity, metric.RSSI,
+			metric.FreeHeap, wifiScanJSON, meshNodesJSON, recordedAt(metric),
+		)
+	}
+
+	results := db.Pool.SendBatch(ctx, batch)
+	var batchErr error
+	for _, metric := range metrics {
+		if err := results.QueryRow().Scan(&metric.ID, &metric.CreatedAt); err != nil {
+			batchErr = err
+			break
+		}
+	}
+	if err := results.Close(); err != nil && batchErr == nil {
+		batchErr = err
+	}
+	if batchErr == nil {
+		return nil
+	}
+
+	var firstErr error
+	for _, metric := range metrics {
+		metric.ID = uuid.Nil
+		if err := db.CreateMetric(ctx, metric); err != nil && firstErr == nil {
+			firstErr = err
+		}
+	}
+	return firstErr
+}
+
 func (db *DB) GetMetricsByDeviceID(ctx context.Context, deviceID uuid.UUID, limit int) ([]models.Metric, error) {
 	query := `
 		SELECT id, device_id, temperature, humidity, rssi, free_heap, wifi_scan, mesh_nodes, created_at
@@ -1,9 +1,11 @@
 package handlers
 
 import (
+	"context"
 	"fmt"
 	"log"
 	"net/http"
+	"sync"
 	"time"
 
 	"github.com/gin-gonic/gin"
@@ -13,13 +15,81 @@ import (
 	"github.com/pfaka/iot-dashboard/internal/websocket"
 )
 
+// Replayed batches older than this (or dated in the future) are dropped: the
+// gateway clock was wrong when they were collected, and metrics this old are
+// removed by the retention job anyway
+const maxReplayAge = 7 * 24 * time.Hour
+
 type GatewayHandler struct {
 	db  *database.DB
 	hub *websocket.Hub
+
+	// Mesh nodes seen in recent batches, so unchanged nodes skip the lookup
+	meshNodes   map[meshNodeKey]*cachedMeshNode
+	meshNodesMu sync.RWMutex
+}
+
+// meshNodeKey identifies a mesh node within its gateway
+type meshNodeKey struct {
+	gatewayID uuid.UUID
+	nodeID    uint32
+}
+
+// cachedMeshNode is a resolved mesh node plus the info last written for it
+type cachedMeshNode struct {
+	device *models.Device
+	info   models.NodeMetricsBatch
 }
 
 func NewGatewayHandler(db *database.DB, hub *websocket.Hub) *GatewayHandler {
-	return &GatewayHandler{db: db, hub: hub}
+	return &GatewayHandler{
+		db:        db,
+		hub:       hub,
+		meshNodes: make(map[meshNodeKey]*cachedMeshNode),
+	}
+}
+
+// lookupMeshNode returns the cached device if the node's name and info are
+// unchanged since it was stored
+func (h *GatewayHandler) lookupMeshNode(key meshNodeKey, nodeData *models.NodeMetricsBatch) (*models.Device, bool) {
+	h.meshNodesMu.RLock()
+	cached, ok := h.meshNodes[key]
+	h.meshNodesMu.RUnlock()
+	if !ok {
+		return nil, false
+	}
+	if cached.info.NodeName != nodeData.NodeName ||
+		cached.info.ChipID != nodeData.ChipID ||
+		cached.info.MAC != nodeData.MAC ||
+		cached.info.Platform != nodeData.Platform ||
+		cached.info.Firmware != nodeData.Firmware {
+		return nil, false
+	}
+	return cached.device, true
+}
+
+func (h *GatewayHandler) cacheMeshNode(key meshNodeKey, device *models.Device, nodeData *models.NodeMetricsBatch) {
+	h.meshNodesMu.Lock()
+	h.meshNodes[key] = &cachedMeshNode{device: device, info: *nodeData}
+	h.meshNodesMu.Unlock()
+}
+
+// replayMeshNode resolves a node for a replayed batch without checking or
+// writing its info, which may be newer than the batch
+func (h *GatewayHandler) replayMeshNode(ctx context.Context, key meshNodeKey, nodeName string) (*models.Device, error) {
+	h.meshNodesMu.RLock()
+	cached, ok := h.meshNodes[key]
+	h.meshNodesMu.RUnlock()
+	if ok {
+		return cached.device, nil
+	}
+	return h.db.GetOrCreateMeshNode(ctx, key.gatewayID, key.nodeID, nodeName)
+}
+
+func (h *GatewayHandler) evictMeshNode(key meshNodeKey) {
+	h.meshNodesMu.Lock()
+	delete(h.meshNodes, key)
+	h.meshNodesMu.Unlock()
 }
 
 // ReceiveBatchMetrics handles batch metrics from a gateway
@@ -47,19 +117,72 @@ func (h *GatewayHandler) ReceiveBatchMetrics(c *gin.Context) {
 		return
 	}
 
-	log.Printf("[BATCH] Received from gateway %s: %d nodes", gateway.Name, len(payload.Nodes))
+	// Batches the gateway replays from its spool are marked with X-Replay.
+	// They only add history: metrics are stored at the time they were
+	// collected, and online state, node info and live updates are left alone.
+	// Live batches use the server clock, as the gateway's may be off.
+	replay := c.GetHeader("X-Replay") != ""
+
+	log.Printf("[BATCH] Received from gateway %s: %d nodes (replay=%t)", gateway.Name, len(payload.Nodes), replay)
 
-	// Update gateway's last seen
 	now := time.Now()
-	gateway.IsOnline = true
-	gateway.LastSeen = &now
-	if err := h.db.UpdateDeviceOnline(c.Request.Context(), gateway.ID, true); err != nil {
-		log.Printf("[BATCH] Failed to update gateway status: %v", err)
+	var recordedAt time.Time
+	if replay {
+		// Never fall back to the server clock here: the old readings would
+		// show up as the latest ones. Answer OK so the gateway discards it.
+		if age := now.Sub(payload.Timestamp); age <= 0 || age >= maxReplayAge {
+			log.Printf("[BATCH] Dropping replayed batch from gateway %s: timestamp %s out of range",
+				gateway.Name, payload.Timestamp.Format(time.RFC3339))
+			c.JSON(http.StatusOK, gin.H{
+				"status":          "dropped",
+				"processed_nodes": 0,
+				"total_nodes":     len(payload.Nodes),
+			})
+			return
+		}
+		recordedAt = payload.Timestamp
+	} else {
+		// Update gateway's last seen
+		gateway.IsOnline = true
+		gateway.LastSeen = &now
+		if err := h.db.UpdateDeviceOnline(c.Request.Context(), gateway.ID, true); err != nil {
+			log.Printf("[BATCH] Failed to update gateway status: %v", err)
+		}
 	}
 
-	// Process each node's metrics
-	processedNodes := 0
-	for _, nodeData := range payload.Nodes {
+	// Resolve mesh nodes and update their info, collecting metrics so they
+	// can be inserted in one round trip
+	nodes := make([]*models.NodeMetricsBatch, 0, len(payload.Nodes))
+	meshNodes := make([]*models.Device, 0, len(payload.Nodes))
+	metrics := make([]*models.Metric, 0, len(payload.Nodes))
+	for i := range payload.Nodes {
+		nodeData := &payload.Nodes[i]
+
+		key := meshNodeKey{gatewayID: gateway.ID, nodeID: nodeData.NodeID}
+
+		if replay {
+			meshNode, err := h.replayMeshNode(c.Request.Context(), key, nodeData.NodeName)
+			if err != nil {
+				log.Printf("[BATCH] Failed to get/create mesh node %d: %v", nodeData.NodeID, err)
+				continue
+			}
+			nodes = append(nodes, nodeData)
+			meshNodes = append(meshNodes, meshNode)
+			metrics = append(metrics, newNodeMetric(meshNode, nodeData, recordedAt))
+			continue
+		}
+
+		// Known node with unchanged info: only refresh its online state
+		if meshNode, ok := h.lookupMeshNode(key, nodeData); ok {
+			if err := h.db.UpdateDeviceOnline(c.Request.Context(), meshNode.ID, true); err != nil {
+				log.Printf("[BATCH] Failed to update mesh node status: %v", err)
+			}
+			nodes = append(nodes, nodeData)
+			meshNodes = append(meshNodes, meshNode)
+			metrics = append(metrics, newNodeMetric(meshNode, nodeData, recordedAt))
+			continue
+		}
+
 		// Get or create mesh node
 		meshNode, err := h.db.GetOrCreateMeshNode(
 			c.Request.Context(),
@@ -82,31 +205,40 @@ func (h *GatewayHandler) ReceiveBatchMetrics(c *gin.Context) {
 			nodeData.Firmware,
 		); err != nil {
 			log.Printf("[BATCH] Failed to update mesh node info: %v", err)
+		} else {
+			h.cacheMeshNode(key, meshNode, nodeData)
 		}
 
-		// Create metrics record
-		metric := &models.Metric{
-			DeviceID:    meshNode.ID,
-			Temperature: &nodeData.Temperature,
-			Humidity:    &nodeData.Humidity,
-			FreeHeap:    &nodeData.FreeHeap,
-			RSSI:        &nodeData.RSSI,
+		nodes = append(nodes, nodeData)
+		meshNodes = append(meshNodes, meshNode)
+		metrics = append(metrics, newNodeMetric(meshNode, nodeData, recordedAt))
+	}
+
+	// Create metrics records
+	if err := h.db.CreateMetrics(c.Request.Context(), metrics); err != nil {
+		log.Printf("[BATCH] Failed to create metrics: %v", err)
+	}
+
+	// Broadcast via WebSocket (live batches only)
+	processedNodes := 0
+	for i, metric := range metrics {
+		if metric.ID == uuid.Nil {
+			// Insert failed, e.g. the node was deleted: resolve it again next time
+			h.evictMeshNode(meshNodeKey{gatewayID: gateway.ID, nodeID: nodes[i].NodeID})
+			continue
 		}
-		if err := h.db.CreateMetric(c.Request.Context(), metric); err != nil {
-			log.Printf("[BATCH] Failed to create metric for node %d: %v", nodeData.NodeID, err)
+		processedNodes++
+		if replay {
 			continue
 		}
 
-		// Broadcast via WebSocket
 		wsPayload := models.DeviceMetricsPayload{
-			NodeName:    nodeData.NodeName,
-			Temperature: &nodeData.Temperature,
-			Humidity:    &nodeData.Humidity,
+			NodeName:    nodes[i].NodeName,
+			Temperature: metric.Temperature,
+			Humidity:    metric.Humidity,
 		}
-		h.hub.BroadcastMetrics(gateway.UserID, meshNode.ID, wsPayload)
-		h.hub.BroadcastDeviceStatus(gateway.UserID, meshNode.ID, true)
-
-		processedNodes++
+		h.hub.BroadcastMetrics(gateway.UserID, meshNodes[i].ID, wsPayload)
+		h.hub.BroadcastDeviceStatus(gateway.UserID, meshNodes[i].ID, true)
 	}
 
 	log.Printf("[BATCH] Processed %d/%d nodes from gateway %s", processedNodes, len(payload.Nodes), gateway.Name)
@@ -125,6 +257,7 @@ func (h *GatewayHandler) ReceiveBatchMetrics(c *gin.Context) {
 			Temperature: &gm.CPUTemp,
 			Humidity:    &gm.MemoryUsage,
 			FreeHeap:    &cpuUsageInt,
+			CreatedAt:   recordedAt,
 		}
 		if err := h.db.CreateMetric(c.Request.Context(), metric); err != nil {
 			log.Printf("[BATCH] Failed to save gateway metrics: %v", err)
@@ -140,6 +273,17 @@ func (h *GatewayHandler) ReceiveBatchMetrics(c *gin.Context) {
 	})
 }
 
+func newNodeMetric(meshNode *models.Device, nodeData *models.NodeMetricsBatch, recordedAt time.Time) *models.Metric {
+	return &models.Metric{
+		DeviceID:    meshNode.ID,
+		Temperature: &nodeData.Temperature,
+		Humidity:    &nodeData.Humidity,
+		FreeHeap:    &nodeData.FreeHeap,
+		RSSI:        &nodeData.RSSI,
+		CreatedAt:   recordedAt,
+	}
+}
+
 // GetGatewayTopology returns the topology of a gateway with all its mesh nodes
 // GET /api/v1/gateways/:id/topology
 func (h *GatewayHandler) GetGatewayTopology(c *gin.Context) {
@@ -0,0 +1,37 @@
+package middleware
+
+import (
+	"compress/gzip"
+	"net/http"
+
+	"github.com/gin-gonic/gin"
+)
+
+// maxDecompressedBody caps inflated request bodies so a small gzip upload
+// cannot expand into an unbounded one
+const maxDecompressedBody = 10 << 20
+
+// GzipRequestMiddleware transparently inflates request bodies sent with
+// Content-Encoding: gzip (used by the mesh gateway for larger batches)
+func GzipRequestMiddleware() gin.HandlerFunc {
+	return func(c *gin.Context) {
+		if c.GetHeader("Content-Encoding") != "gzip" {
+			c.Next()
+			return
+		}
+
+		reader, err := gzip.NewReader(c.Request.Body)
+		if err != nil {
+			c.JSON(http.StatusBadRequest, gin.H{"error": "Invalid gzip body"})
+			c.Abort()
+			return
+		}
+		defer reader.Close()
+
+		c.Request.Body = http.MaxBytesReader(c.Writer, reader, maxDecompressedBody)
+		c.Request.Header.Del("Content-Encoding")
+		c.Request.ContentLength = -1
+
+		c.Next()
+	}
+}
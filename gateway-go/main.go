@@ -3,19 +3,25 @@ package main
 import (
 	"bufio"
 	"bytes"
+	"compress/gzip"
+	"context"
 	"encoding/json"
+	"errors"
 	"flag"
 	"fmt"
 	"io"
 	"log"
+	"net"
 	"net/http"
 	"os"
 	"os/exec"
 	"os/signal"
+	"path/filepath"
 	"sort"
 	"strconv"
 	"strings"
 	"sync"
+	"sync/atomic"
 	"syscall"
 	"time"
 
@@ -26,6 +32,58 @@ import (
 const VERSION = "2.2.0"
 const TOKEN_FILE = "/etc/mesh-gateway/token"
 
+// Batches that never reached the backend are spooled here (one JSON per
+// line) and replayed after each successful live batch, at most
+// MAX_REPLAY_BATCHES within one batch interval. When the spool outgrows
+// MAX_SPOOL_SIZE it is rotated to SPOOL_FILE.old, replacing the oldest data.
+const (
+	SPOOL_FILE         = "/var/lib/mesh-gateway/spool.ndjson"
+	MAX_SPOOL_SIZE     = 4 << 20
+	MAX_REPLAY_BATCHES = 20
+)
+
+// Backend HTTP client tuning
+const (
+	MAX_IDLE_CONNS      = 32
+	IDLE_CONN_TIMEOUT   = 90 * time.Second
+	MAX_BACKEND_RETRIES = 3
+	RETRY_BACKOFF       = 200 * time.Millisecond
+)
+
+// SERIAL_QUEUE_SIZE bounds the lines buffered between the serial reader and
+// the message processor
+const SERIAL_QUEUE_SIZE = 256
+
+// SERIAL_READ_BUFFER is large enough to drain a whole burst from the bridge
+// in a single read syscall
+const SERIAL_READ_BUFFER = 64 * 1024
+
+// SERIAL_SETTLE_DELAY is waited after opening the port before flushing it
+const SERIAL_SETTLE_DELAY = 200 * time.Millisecond
+
+// Shared header values for backend request bodies
+var (
+	jsonContentType = []string{"application/json"}
+	gzipEncoding    = []string{"gzip"}
+	replayMarker    = []string{"1"}
+)
+
+// GZIP_MIN_SIZE is the body size above which backend requests are gzipped
+const GZIP_MIN_SIZE = 1024
+
+// gzipPool recycles gzip writers, which carry sizable compressor state
+var gzipPool = sync.Pool{
+	New: func() any {
+		w, _ := gzip.NewWriterLevel(nil, gzip.BestSpeed)
+		return w
+	},
+}
+
+// bufferPool recycles the buffers backend request bodies are encoded into
+var bufferPool = sync.Pool{
+	New: func() any { return new(bytes.Buffer) },
+}
+
 // ConfigFile represents the YAML config structure
 type ConfigFile struct {
 	Serial struct {
@@ -87,16 +145,30 @@ type Gateway struct {
 	config     Config
 	port       serial.Port
 	portMu     sync.Mutex
+	lines      chan []byte
+	pollWake   chan struct{}
+	ackSlots   chan struct{}
 	httpClient *http.Client
 	nodes      map[uint32]*MeshNode
 	nodesMu    sync.RWMutex
-	running    bool
+	batchNodes []NodeMetric    // reused by sendBatchMetrics between batches
+	ctx        context.Context // Cancelled by Stop; ends workers and in-flight requests
+	cancel     context.CancelFunc
 	stats      Stats
 	logFile    *os.File
 	// Logs buffers
 	serialLogs  []LogEntry
 	gatewayLogs []LogEntry
 	logsMu      sync.RWMutex
+	// Backend token, replaced as a whole when set from the web UI
+	token atomic.Pointer[gatewayToken]
+}
+
+// gatewayToken is the token plus its header value, built once when the
+// token is set instead of per request
+type gatewayToken struct {
+	value  string
+	header []string
 }
 
 // LogEntry for storing logs
@@ -116,32 +188,45 @@ type BackendCommand struct {
 	CreatedAt string `json:"created_at"`
 }
 
-// Stats tracks gateway statistics
+// Stats tracks gateway statistics. Counters are atomic so the reader,
+// processor and HTTP goroutines never contend on a lock to bump them.
 type Stats struct {
-	MessagesReceived int64
-	MetricsReceived  int64
-	BatchesSent      int64
-	CommandsSent     int64
-	Errors           int64
-	LastBatchTime    time.Time
+	MessagesReceived atomic.Int64
+	MetricsReceived  atomic.Int64
+	BatchesSent      atomic.Int64
+	CommandsSent     atomic.Int64
+	Errors           atomic.Int64
+	LastBatchTime    time.Time // guarded by mu
 	StartTime        time.Time
 	mu               sync.Mutex
 }
 
 // MeshMessage from ESP32 bridge
 type MeshMessage struct {
-	Type       string          `json:"type"`
-	From       uint32          `json:"from,omitempty"`
-	NodeID     uint32          `json:"node_id,omitempty"`
-	Data       json.RawMessage `json:"data,omitempty"`
-	TotalNodes int             `json:"total,omitempty"`
-	Msg        string          `json:"msg,omitempty"`
-	Firmware   string          `json:"firmware,omitempty"`
-	Nodes      int             `json:"nodes,omitempty"`
-	Heap       uint32          `json:"heap,omitempty"`
-	Uptime     uint64          `json:"uptime,omitempty"`
-	Temp       float64         `json:"temp,omitempty"`
-	Hum        float64         `json:"hum,omitempty"`
+	Type       string       `json:"type"`
+	From       uint32       `json:"from,omitempty"`
+	NodeID     uint32       `json:"node_id,omitempty"`
+	Data       *MetricsData `json:"data,omitempty"` // Decoded in the same pass as the envelope
+	TotalNodes int          `json:"total,omitempty"`
+	Msg        string       `json:"msg,omitempty"`
+	Firmware   string       `json:"firmware,omitempty"`
+	Nodes      int          `json:"nodes,omitempty"`
+	Heap       uint32       `json:"heap,omitempty"`
+	Uptime     uint64       `json:"uptime,omitempty"`
+	Temp       float64      `json:"temp,omitempty"`
+	Hum        float64      `json:"hum,omitempty"`
+}
+
+// MeshCommand to ESP32 bridge
+type MeshCommand struct {
+	Type   string          `json:"type"`
+	Target uint32          `json:"target,omitempty"`
+	Data   MeshCommandData `json:"data"`
+}
+
+type MeshCommandData struct {
+	Cmd   string      `json:"cmd"`
+	Value interface{} `json:"value"`
 }
 
 // MetricsData from mesh node
@@ -319,12 +404,176 @@ func loadConfigFile(path string, config *Config) error {
 }
 
 func NewGateway(config Config) *Gateway {
-	return &Gateway{
+	g := &Gateway{
 		config:     config,
 		nodes:      make(map[uint32]*MeshNode),
-		httpClient: &http.Client{Timeout: 15 * time.Second},
+		lines:      make(chan []byte, SERIAL_QUEUE_SIZE),
+		pollWake:   make(chan struct{}, 1),
+		ackSlots:   make(chan struct{}, MAX_PENDING_ACKS),
+		httpClient: newHTTPClient(),
 		stats:      Stats{StartTime: time.Now()},
 	}
+	g.ctx, g.cancel = context.WithCancel(context.Background())
+	g.setGatewayToken(config.GatewayToken)
+	return g
+}
+
+// setGatewayToken updates the token and the header value derived from it.
+// It is safe to call while requests are being sent.
+func (g *Gateway) setGatewayToken(token string) {
+	g.token.Store(&gatewayToken{value: token, header: []string{token}})
+}
+
+// gatewayToken returns the current backend token
+func (g *Gateway) gatewayToken() string {
+	return g.token.Load().value
+}
+
+// newHTTPClient builds the backend client. All backend traffic goes to the
+// same host, so the pool keeps enough idle keep-alive connections around to
+// skip the TCP+TLS handshake on every batch, poll and ack.
+func newHTTPClient() *http.Client {
+	transport := &http.Transport{
+		Proxy: http.ProxyFromEnvironment,
+		DialContext: (&net.Dialer{
+			Timeout:   10 * time.Second,
+			KeepAlive: 30 * time.Second,
+		}).DialContext,
+		MaxIdleConns:          MAX_IDLE_CONNS,
+		MaxIdleConnsPerHost:   MAX_IDLE_CONNS,
+		IdleConnTimeout:       IDLE_CONN_TIMEOUT,
+		TLSHandshakeTimeout:   10 * time.Second,
+		ExpectContinueTimeout: 1 * time.Second,
+		// A custom Transport only speaks HTTP/1.1 unless asked. With HTTP/2,
+		// batches, polls and acks are multiplexed over one TLS connection
+		// whenever the server offers h2 (it falls back to 1.1 otherwise).
+		ForceAttemptHTTP2: true,
+	}
+	return &http.Client{Timeout: 15 * time.Second, Transport: transport}
+}
+
+// newBackendRequest builds a backend request carrying the gateway token.
+// Bodies over GZIP_MIN_SIZE are sent gzipped from a pooled buffer; the caller
+// must call release once the response body is closed.
+func (g *Gateway) newBackendRequest(method, path string, body []byte) (req *http.Request, release func(), err error) {
+	release = noRelease
+	compressed := false
+	if len(body) > GZIP_MIN_SIZE {
+		gz := bufferPool.Get().(*bytes.Buffer)
+		if err := gzipBody(gz, body); err == nil {
+			body = gz.Bytes()
+			compressed = true
+			release = func() { bufferPool.Put(gz) }
+		} else {
+			bufferPool.Put(gz)
+		}
+	}
+
+	var reader io.Reader
+	if body != nil {
+		reader = bytes.NewReader(body)
+	}
+	req, err = http.NewRequestWithContext(g.ctx, method, g.config.BackendURL+path, reader)
+	if err != nil {
+		release()
+		return nil, noRelease, err
+	}
+	// Keys are already canonical, so assign directly and skip Header.Set's
+	// canonicalization and per-request slice allocation
+	if body != nil {
+		req.Header["Content-Type"] = jsonContentType
+	}
+	if compressed {
+		req.Header["Content-Encoding"] = gzipEncoding
+	}
+	req.Header["X-Gateway-Token"] = g.token.Load().header
+	return req, release, nil
+}
+
+func noRelease() {}
+
+// gzipBody compresses body into dst at BestSpeed, which costs little CPU on
+// a Pi
+func gzipBody(dst *bytes.Buffer, body []byte) error {
+	dst.Reset()
+	zw := gzipPool.Get().(*gzip.Writer)
+	defer func() {
+		zw.Reset(io.Discard) // Don't keep dst alive while pooled
+		gzipPool.Put(zw)
+	}()
+
+	zw.Reset(dst)
+	if _, err := zw.Write(body); err != nil {
+		return err
+	}
+	return zw.Close()
+}
+
+// doBackendRequest sends req, retrying with backoff when the backend (or the
+// proxy in front of it) answers 502/503, which means the request never reached
+// a handler. Idempotent requests (see isIdempotent) are also retried on 504 and
+// on connection errors, where the handler may already have run; others are not,
+// so a metrics batch is never inserted twice.
+func (g *Gateway) doBackendRequest(req *http.Request) (*http.Response, error) {
+	idempotent := isIdempotent(req)
+	backoff := RETRY_BACKOFF
+	for attempt := 0; ; attempt++ {
+		resp, err := g.httpClient.Do(req)
+		if attempt >= MAX_BACKEND_RETRIES || g.ctx.Err() != nil {
+			return resp, err
+		}
+		if err != nil {
+			if !idempotent {
+				return nil, err
+			}
+		} else {
+			if !isRetryableStatus(resp.StatusCode, idempotent) {
+				return resp, nil
+			}
+			drainAndClose(resp.Body)
+		}
+		select {
+		case <-g.ctx.Done():
+			return nil, g.ctx.Err()
+		case <-time.After(backoff):
+		}
+		backoff *= 2
+
+		if req.GetBody != nil {
+			body, err := req.GetBody()
+			if err != nil {
+				return nil, err
+			}
+			req.Body = body
+		}
+	}
+}
+
+// isIdempotent follows net/http: GET and friends, or any request carrying an
+// Idempotency-Key header. A nil key marks a request without sending it.
+func isIdempotent(req *http.Request) bool {
+	switch req.Method {
+	case "GET", "HEAD", "OPTIONS", "TRACE":
+		return true
+	}
+	if _, ok := req.Header["Idempotency-Key"]; ok {
+		return true
+	}
+	_, ok := req.Header["X-Idempotency-Key"]
+	return ok
+}
+
+func isRetryableStatus(code int, idempotent bool) bool {
+	return code == http.StatusBadGateway ||
+		code == http.StatusServiceUnavailable ||
+		(idempotent && code == http.StatusGatewayTimeout)
+}
+
+// drainAndClose discards the rest of the body so the connection goes back
+// to the keep-alive pool instead of being torn down.
+func drainAndClose(body io.ReadCloser) {
+	io.Copy(io.Discard, io.LimitReader(body, 64<<10))
+	body.Close()
 }
 
 func (g *Gateway) Run() error {
@@ -342,13 +591,13 @@ func (g *Gateway) Run() error {
 	log.Println("╚══════════════════════════════════════════════════════════╝")
 	log.Printf("Serial:   %s @ %d baud", g.config.SerialPort, g.config.BaudRate)
 	log.Printf("Backend:  %s", g.config.BackendURL)
-	log.Printf("Token:    %s", maskToken(g.config.GatewayToken))
+	log.Printf("Token:    %s", maskToken(g.gatewayToken()))
 	log.Printf("Web UI:   http://0.0.0.0:%d", g.config.WebPort)
 	log.Printf("Interval: %s", g.config.BatchInterval)
 	log.Println("────────────────────────────────────────────────────────────")
 
 	// Validate token
-	if g.config.GatewayToken == "" {
+	if g.gatewayToken() == "" {
 		log.Println("⚠️  WARNING: No gateway token configured!")
 		log.Println("   Metrics will NOT be sent to backend.")
 		log.Println("   Set token in config file or use --token flag")
@@ -362,9 +611,8 @@ func (g *Gateway) Run() error {
 		log.Println("✅ Serial connected")
 	}
 
-	g.running = true
-
 	// Start workers
+	go g.serialProcessor()
 	go g.batchSender()
 	go g.nodeTimeoutChecker()
 	go g.commandPoller()
@@ -391,10 +639,11 @@ func maskToken(token string) string {
 }
 
 func (g *Gateway) Stop() {
-	g.running = false
+	g.cancel()
 	if g.port != nil {
 		g.port.Close()
 	}
+	g.httpClient.CloseIdleConnections()
 	if g.logFile != nil {
 		g.logFile.Close()
 	}
@@ -414,7 +663,20 @@ func (g *Gateway) connectSerial() error {
 		return err
 	}
 
+	// Let the bridge settle, then drop whatever the kernel buffered while the
+	// port was closed so the reader starts on a clean line boundary
+	time.Sleep(SERIAL_SETTLE_DELAY)
+	if err := port.ResetInputBuffer(); err != nil {
+		log.Printf("Serial input reset failed: %v", err)
+	}
+	if err := port.ResetOutputBuffer(); err != nil {
+		log.Printf("Serial output reset failed: %v", err)
+	}
+
 	g.portMu.Lock()
+	if g.port != nil {
+		g.port.Close()
+	}
 	g.port = port
 	g.portMu.Unlock()
 
@@ -422,58 +684,91 @@ func (g *Gateway) connectSerial() error {
 }
 
 func (g *Gateway) readSerial() {
-	reader := bufio.NewReader(g.port)
+	reader := bufio.NewReaderSize(g.port, SERIAL_READ_BUFFER)
 	reconnectDelay := 5 * time.Second
-
-	for g.running {
-		line, err := reader.ReadString('\n')
+	overflow := false // Inside a line longer than the read buffer
+
+	for g.ctx.Err() == nil {
+		// ReadSlice returns a view into the reader's buffer, so nothing is
+		// allocated for lines that get filtered out below
+		line, err := reader.ReadSlice('\n')
+		if err == bufio.ErrBufferFull {
+			overflow = true
+			continue // Garbage or corrupted stream; skip to the next newline
+		}
 		if err != nil {
+			if g.ctx.Err() != nil {
+				return
+			}
+			// Any read error leaves the port unusable (unplugged, EIO, closed),
+			// so back off and reopen instead of spinning on the dead handle
 			if err == io.EOF {
 				log.Println("Serial disconnected, reconnecting...")
-				time.Sleep(reconnectDelay)
-				if err := g.connectSerial(); err != nil {
-					log.Printf("Reconnect failed: %v", err)
-					continue
-				}
-				reader = bufio.NewReader(g.port)
-				log.Println("✅ Serial reconnected")
+			} else {
+				log.Printf("Serial error: %v, reconnecting...", err)
+			}
+			time.Sleep(reconnectDelay)
+			if err := g.connectSerial(); err != nil {
+				log.Printf("Reconnect failed: %v", err)
 				continue
 			}
-			log.Printf("Serial error: %v", err)
+			reader = bufio.NewReaderSize(g.port, SERIAL_READ_BUFFER)
+			overflow = false
+			log.Println("✅ Serial reconnected")
 			continue
 		}
+		if overflow {
+			overflow = false
+			continue // Tail of an overlong line
+		}
 
-		line = strings.TrimSpace(line)
+		line = bytes.TrimSpace(line)
 		if len(line) == 0 || line[0] != '{' {
 			continue // Skip non-JSON
 		}
 
+		// Hand off without blocking so a slow consumer never stalls the port.
+		// The copy is needed because the next read reuses the buffer.
+		select {
+		case g.lines <- bytes.Clone(line):
+		default:
+			g.stats.Errors.Add(1)
+			if g.config.Debug {
+				log.Printf("[RX] Queue full, dropped: %s", line)
+			}
+		}
+	}
+}
+
+// serialProcessor consumes lines queued by readSerial
+func (g *Gateway) serialProcessor() {
+	for line := range g.lines {
 		if g.config.Debug {
 			log.Printf("[RX] %s", line)
 		}
-
 		g.processMessage(line)
 	}
 }
 
-func (g *Gateway) processMessage(line string) {
+func (g *Gateway) processMessage(line []byte) {
+	// One clock read per message, shared by the serial log and node updates
+	now := time.Now()
+
 	// Log raw serial data
-	g.addSerialLog("data", strings.TrimSpace(line))
+	g.addSerialLog(now, "data", string(line))
 
 	var msg MeshMessage
-	if err := json.Unmarshal([]byte(line), &msg); err != nil {
+	if err := json.Unmarshal(line, &msg); err != nil {
 		return
 	}
 
-	g.stats.mu.Lock()
-	g.stats.MessagesReceived++
-	g.stats.mu.Unlock()
+	g.stats.MessagesReceived.Add(1)
 
 	switch msg.Type {
 	case "mesh_data":
-		g.handleMeshData(msg)
+		g.handleMeshData(msg, now)
 	case "heartbeat":
-		g.handleHeartbeat(msg)
+		g.handleHeartbeat(msg, now)
 	case "node_connected":
 		log.Printf("📡 Node connected: %d (total: %d)", msg.NodeID, msg.TotalNodes)
 	case "node_disconnected":
@@ -481,16 +776,22 @@ func (g *Gateway) processMessage(line string) {
 		log.Printf("📴 Node disconnected: %d", msg.NodeID)
 	case "ready":
 		log.Printf("✅ Bridge ready: %s (ID: %d)", msg.Firmware, msg.NodeID)
+		// Deliver commands queued while the bridge was down right away
+		g.wakeCommandPoller()
 	case "boot":
 		log.Printf("🔄 Bridge booting: %s", msg.Firmware)
 	case "ack":
 		if g.config.Debug {
 			log.Printf("[ACK] Command acknowledged")
 		}
+	default:
+		if g.config.Debug {
+			log.Printf("[RX] Unhandled message type: %q", msg.Type)
+		}
 	}
 }
 
-func (g *Gateway) handleHeartbeat(msg MeshMessage) {
+func (g *Gateway) handleHeartbeat(msg MeshMessage, now time.Time) {
 	// Bridge sends heartbeat with its own metrics
 	if msg.Temp > 0 || msg.Hum > 0 {
 		g.nodesMu.Lock()
@@ -509,27 +810,22 @@ func (g *Gateway) handleHeartbeat(msg MeshMessage) {
 		node.Humidity = msg.Hum
 		node.FreeHeap = int64(msg.Heap)
 		node.IsOnline = true
-		node.LastSeen = time.Now()
+		node.LastSeen = now
 		g.nodesMu.Unlock()
 	}
 }
 
-func (g *Gateway) handleMeshData(msg MeshMessage) {
-	var data MetricsData
-	if err := json.Unmarshal(msg.Data, &data); err != nil {
-		// Try flat format (from bridge itself)
-		if err := json.Unmarshal(msg.Data, &data); err != nil {
-			return
-		}
+func (g *Gateway) handleMeshData(msg MeshMessage, now time.Time) {
+	data := msg.Data
+	if data == nil {
+		return
 	}
 
 	if data.MsgType != "metrics" {
 		return
 	}
 
-	g.stats.mu.Lock()
-	g.stats.MetricsReceived++
-	g.stats.mu.Unlock()
+	g.stats.MetricsReceived.Add(1)
 
 	// Update node
 	g.nodesMu.Lock()
@@ -551,7 +847,7 @@ func (g *Gateway) handleMeshData(msg MeshMessage) {
 	node.RSSI = data.RSSI
 	node.IsRoot = data.IsRoot
 	node.IsOnline = true
-	node.LastSeen = time.Now()
+	node.LastSeen = now
 	g.nodesMu.Unlock()
 
 	log.Printf("📊 [%s] T=%.1f°C H=%.0f%% RSSI=%d", data.NodeName, data.Temperature, data.Humidity, data.RSSI)
@@ -569,8 +865,13 @@ func (g *Gateway) nodeTimeoutChecker() {
 	ticker := time.NewTicker(30 * time.Second)
 	defer ticker.Stop()
 
-	for g.running {
-		<-ticker.C
+	for {
+		select {
+		case <-g.ctx.Done():
+			return
+		case <-ticker.C:
+		}
+
 		now := time.Now()
 		g.nodesMu.Lock()
 		for _, node := range g.nodes {
@@ -587,19 +888,23 @@ func (g *Gateway) batchSender() {
 	ticker := time.NewTicker(g.config.BatchInterval)
 	defer ticker.Stop()
 
-	for g.running {
-		<-ticker.C
-		g.sendBatchMetrics()
+	for {
+		select {
+		case <-g.ctx.Done():
+			return
+		case <-ticker.C:
+			g.sendBatchMetrics()
+		}
 	}
 }
 
 func (g *Gateway) sendBatchMetrics() {
-	if g.config.GatewayToken == "" {
+	if g.gatewayToken() == "" {
 		return // No token, skip
 	}
 
 	g.nodesMu.RLock()
-	var metrics []NodeMetric
+	metrics := g.batchNodes[:0]
 	for _, node := range g.nodes {
 		if node.IsOnline {
 			metrics = append(metrics, NodeMetric{
@@ -618,6 +923,7 @@ func (g *Gateway) sendBatchMetrics() {
 		}
 	}
 	g.nodesMu.RUnlock()
+	g.batchNodes = metrics
 
 	// Collect gateway metrics (always send, even without nodes)
 	gatewayMetrics := g.collectGatewayMetrics()
@@ -630,26 +936,31 @@ func (g *Gateway) sendBatchMetrics() {
 		GatewayMetrics: gatewayMetrics,
 	}
 
-	jsonData, _ := json.Marshal(payload)
+	buf := bufferPool.Get().(*bytes.Buffer)
+	buf.Reset()
+	defer bufferPool.Put(buf)
+	json.NewEncoder(buf).Encode(payload)
 
-	url := g.config.BackendURL + "/api/v1/gateway/metrics"
-	req, _ := http.NewRequest("POST", url, bytes.NewBuffer(jsonData))
-	req.Header.Set("Content-Type", "application/json")
-	req.Header.Set("X-Gateway-Token", g.config.GatewayToken)
+	req, release, err := g.newBackendRequest("POST", "/api/v1/gateway/metrics", buf.Bytes())
+	if err != nil {
+		return
+	}
+	defer release()
 
-	resp, err := g.httpClient.Do(req)
+	resp, err := g.doBackendRequest(req)
 	if err != nil {
 		log.Printf("❌ Backend error: %v", err)
-		g.stats.mu.Lock()
-		g.stats.Errors++
-		g.stats.mu.Unlock()
+		g.stats.Errors.Add(1)
+		if notDelivered(0, err) {
+			g.spoolBatch(buf.Bytes())
+		}
 		return
 	}
-	defer resp.Body.Close()
+	defer drainAndClose(resp.Body)
 
 	if resp.StatusCode == 200 || resp.StatusCode == 201 {
+		g.stats.BatchesSent.Add(1)
 		g.stats.mu.Lock()
-		g.stats.BatchesSent++
 		g.stats.LastBatchTime = time.Now()
 		g.stats.mu.Unlock()
 		if gatewayMetrics != nil {
@@ -658,12 +969,136 @@ func (g *Gateway) sendBatchMetrics() {
 		} else {
 			log.Printf("✅ Sent %d nodes to backend", len(metrics))
 		}
+		// The backend is reachable again: catch up on what it missed
+		g.replaySpool()
 	} else {
 		body, _ := io.ReadAll(resp.Body)
 		log.Printf("❌ Backend responded %d: %s", resp.StatusCode, string(body))
-		g.stats.mu.Lock()
-		g.stats.Errors++
-		g.stats.mu.Unlock()
+		g.stats.Errors.Add(1)
+		if notDelivered(resp.StatusCode, nil) {
+			g.spoolBatch(buf.Bytes())
+		}
+	}
+}
+
+// notDelivered reports whether a batch certainly never reached the metrics
+// handler, so sending it again cannot insert its rows twice: the connection
+// could not be made, the proxy had no backend for it (502/503), Cloud Run
+// could not scale (429), or the token was refused (401/403) and may be fixed
+// from the web UI. Timeouts, 500 and 504 are left out, as the rows may
+// already be stored.
+func notDelivered(status int, err error) bool {
+	if err != nil {
+		var opErr *net.OpError
+		return errors.As(err, &opErr) && opErr.Op == "dial"
+	}
+	return status == http.StatusBadGateway ||
+		status == http.StatusServiceUnavailable ||
+		status == http.StatusTooManyRequests ||
+		status == http.StatusUnauthorized ||
+		status == http.StatusForbidden
+}
+
+// postBatch sends a spooled batch, marked as a replay so the backend only
+// stores it as history, and returns the response status
+func (g *Gateway) postBatch(body []byte) (int, error) {
+	req, release, err := g.newBackendRequest("POST", "/api/v1/gateway/metrics", body)
+	if err != nil {
+		return 0, err
+	}
+	defer release()
+	req.Header["X-Replay"] = replayMarker
+	resp, err := g.doBackendRequest(req)
+	if err != nil {
+		return 0, err
+	}
+	drainAndClose(resp.Body)
+	return resp.StatusCode, nil
+}
+
+// spoolBatch appends a batch that never reached the backend to the spool file
+func (g *Gateway) spoolBatch(body []byte) {
+	if err := os.MkdirAll(filepath.Dir(SPOOL_FILE), 0755); err != nil {
+		log.Printf("❌ Spool error: %v", err)
+		return
+	}
+	if info, err := os.Stat(SPOOL_FILE); err == nil && info.Size()+int64(len(body)) > MAX_SPOOL_SIZE {
+		if err := os.Rename(SPOOL_FILE, SPOOL_FILE+".old"); err != nil {
+			log.Printf("❌ Spool rotate error: %v", err)
+		}
+	}
+
+	f, err := os.OpenFile(SPOOL_FILE, os.O_APPEND|os.O_CREATE|os.O_WRONLY, 0600)
+	if err != nil {
+		log.Printf("❌ Spool error: %v", err)
+		return
+	}
+	defer f.Close()
+
+	if !bytes.HasSuffix(body, []byte{'\n'}) {
+		body = append(body[:len(body):len(body)], '\n')
+	}
+	if _, err := f.Write(body); err != nil {
+		log.Printf("❌ Spool error: %v", err)
+		return
+	}
+	f.Sync()
+	log.Printf("💾 Batch spooled for retry")
+}
+
+// replaySpool resends up to MAX_REPLAY_BATCHES spooled batches, oldest
+// first, within one batch interval so the next live batch is not held up.
+// It stops at the first batch the backend cannot take yet and keeps the rest
+// on disk in order.
+func (g *Gateway) replaySpool() {
+	deadline := time.Now().Add(g.config.BatchInterval)
+	replayed := 0
+	defer func() {
+		if replayed > 0 {
+			log.Printf("📤 Replayed %d spooled batches", replayed)
+		}
+	}()
+
+	for _, path := range []string{SPOOL_FILE + ".old", SPOOL_FILE} {
+		data, err := os.ReadFile(path)
+		if err != nil {
+			continue
+		}
+
+		rest := data
+		for len(rest) > 0 && replayed < MAX_REPLAY_BATCHES && time.Now().Before(deadline) {
+			line, next, _ := bytes.Cut(rest, []byte{'\n'})
+			if len(line) == 0 {
+				rest = next
+				continue
+			}
+			status, err := g.postBatch(line)
+			if notDelivered(status, err) {
+				break // Backend still unavailable, keep the batch
+			}
+			// Delivered, rejected for good, or its outcome is unknown: either
+			// way it must not be sent again
+			rest = next
+			replayed++
+			if err != nil || status >= 500 {
+				break // Backend struggling, try the rest next time
+			}
+		}
+
+		if len(rest) == 0 {
+			os.Remove(path)
+			continue
+		}
+		if len(rest) == len(data) {
+			return // Nothing sent, the file is unchanged
+		}
+
+		// Keep what is left; write and rename so a crash never truncates it
+		tmp := path + ".tmp"
+		if err := os.WriteFile(tmp, rest, 0600); err == nil {
+			os.Rename(tmp, path)
+		}
+		return
 	}
 }
 
@@ -797,22 +1232,18 @@ func (g *Gateway) SendCommand(nodeID uint32, command string, value interface{})
 		return fmt.Errorf("serial not connected")
 	}
 
-	cmd := map[string]interface{}{
-		"type":   "send",
-		"target": nodeID,
-		"data":   map[string]interface{}{"cmd": command, "value": value},
+	cmd := MeshCommand{
+		Type:   "send",
+		Target: nodeID,
+		Data:   MeshCommandData{Cmd: command, Value: value},
 	}
 
-	data, _ := json.Marshal(cmd)
-	data = append(data, '\n')
-
-	if _, err := g.port.Write(data); err != nil {
+	// Encode appends the newline the bridge expects and writes in one call
+	if err := json.NewEncoder(g.port).Encode(cmd); err != nil {
 		return err
 	}
 
-	g.stats.mu.Lock()
-	g.stats.CommandsSent++
-	g.stats.mu.Unlock()
+	g.stats.CommandsSent.Add(1)
 
 	log.Printf("📤 Command '%s' → Node %d", command, nodeID)
 	return nil
@@ -826,15 +1257,13 @@ func (g *Gateway) BroadcastCommand(command string, value interface{}) error {
 		return fmt.Errorf("serial not connected")
 	}
 
-	cmd := map[string]interface{}{
-		"type": "broadcast",
-		"data": map[string]interface{}{"cmd": command, "value": value},
+	cmd := MeshCommand{
+		Type: "broadcast",
+		Data: MeshCommandData{Cmd: command, Value: value},
 	}
 
-	data, _ := json.Marshal(cmd)
-	data = append(data, '\n')
-
-	if _, err := g.port.Write(data); err != nil {
+	// Encode appends the newline the bridge expects and writes in one call
+	if err := json.NewEncoder(g.port).Encode(cmd); err != nil {
 		return err
 	}
 
@@ -881,11 +1310,9 @@ func (g *Gateway) handleIndex(w http.ResponseWriter, r *http.Request) {
 		return nodes[i].NodeID < nodes[j].NodeID
 	})
 
-	g.stats.mu.Lock()
-	messagesReceived := g.stats.MessagesReceived
-	batchesSent := g.stats.BatchesSent
+	messagesReceived := g.stats.MessagesReceived.Load()
+	batchesSent := g.stats.BatchesSent.Load()
 	startTime := g.stats.StartTime
-	g.stats.mu.Unlock()
 
 	onlineCount := 0
 	for _, n := range nodes {
@@ -902,7 +1329,7 @@ func (g *Gateway) handleIndex(w http.ResponseWriter, r *http.Request) {
 
 func (g *Gateway) renderHTML(w http.ResponseWriter, nodes []*MeshNode, onlineCount int, messages, batches int64, uptime string) {
 	totalNodes := len(nodes)
-	hasToken := g.config.GatewayToken != ""
+	hasToken := g.gatewayToken() != ""
 
 	html := fmt.Sprintf(`<!DOCTYPE html>
 <html>
@@ -1074,16 +1501,14 @@ func (g *Gateway) handleAPINodes(w http.ResponseWriter, r *http.Request) {
 }
 
 func (g *Gateway) handleAPIStats(w http.ResponseWriter, r *http.Request) {
-	g.stats.mu.Lock()
 	data := map[string]interface{}{
-		"messages":       g.stats.MessagesReceived,
-		"metrics":        g.stats.MetricsReceived,
-		"batches":        g.stats.BatchesSent,
-		"commands":       g.stats.CommandsSent,
-		"errors":         g.stats.Errors,
+		"messages":       g.stats.MessagesReceived.Load(),
+		"metrics":        g.stats.MetricsReceived.Load(),
+		"batches":        g.stats.BatchesSent.Load(),
+		"commands":       g.stats.CommandsSent.Load(),
+		"errors":         g.stats.Errors.Load(),
 		"uptime_seconds": time.Since(g.stats.StartTime).Seconds(),
 	}
-	g.stats.mu.Unlock()
 	w.Header().Set("Content-Type", "application/json")
 	json.NewEncoder(w).Encode(data)
 }
@@ -1132,23 +1557,21 @@ func (g *Gateway) handleAPIBroadcast(w http.ResponseWriter, r *http.Request) {
 }
 
 func (g *Gateway) printStats() {
-	g.stats.mu.Lock()
-	defer g.stats.mu.Unlock()
 	log.Println("════════════════════════════════════════")
 	log.Println("📊 Final Statistics")
 	log.Printf("   Uptime: %s", formatDuration(time.Since(g.stats.StartTime)))
-	log.Printf("   Messages: %d", g.stats.MessagesReceived)
-	log.Printf("   Batches: %d", g.stats.BatchesSent)
-	log.Printf("   Commands: %d", g.stats.CommandsSent)
-	log.Printf("   Errors: %d", g.stats.Errors)
+	log.Printf("   Messages: %d", g.stats.MessagesReceived.Load())
+	log.Printf("   Batches: %d", g.stats.BatchesSent.Load())
+	log.Printf("   Commands: %d", g.stats.CommandsSent.Load())
+	log.Printf("   Errors: %d", g.stats.Errors.Load())
 	log.Println("════════════════════════════════════════")
 }
 
 func (g *Gateway) handleSettings(w http.ResponseWriter, r *http.Request) {
-	hasToken := g.config.GatewayToken != ""
+	t := g.gatewayToken()
+	hasToken := t != ""
 	tokenMasked := ""
 	if hasToken {
-		t := g.config.GatewayToken
 		if len(t) > 8 {
 			tokenMasked = t[:4] + "..." + t[len(t)-4:]
 		} else {
@@ -1275,7 +1698,7 @@ func (g *Gateway) handleAPISettings(w http.ResponseWriter, r *http.Request) {
 
 	if r.Method == "GET" {
 		json.NewEncoder(w).Encode(map[string]interface{}{
-			"has_token":   g.config.GatewayToken != "",
+			"has_token":   g.gatewayToken() != "",
 			"backend_url": g.config.BackendURL,
 			"serial_port": g.config.SerialPort,
 		})
@@ -1308,8 +1731,9 @@ func (g *Gateway) handleAPISettings(w http.ResponseWriter, r *http.Request) {
 	}
 
 	// Update runtime config
-	g.config.GatewayToken = req.Token
+	g.setGatewayToken(req.Token)
 	log.Printf("✅ Token updated via web UI")
+	g.wakeCommandPoller()
 
 	json.NewEncoder(w).Encode(map[string]string{"message": "Token saved successfully"})
 }
@@ -1318,15 +1742,15 @@ func (g *Gateway) handleAPISettings(w http.ResponseWriter, r *http.Request) {
 
 const MAX_LOG_ENTRIES = 500
 
-func (g *Gateway) addSerialLog(level, message string) {
-	g.logsMu.Lock()
-	defer g.logsMu.Unlock()
-	
+func (g *Gateway) addSerialLog(at time.Time, level, message string) {
 	entry := LogEntry{
-		Timestamp: time.Now(),
+		Timestamp: at,
 		Level:     level,
 		Message:   message,
 	}
+
+	g.logsMu.Lock()
+	defer g.logsMu.Unlock()
 	g.serialLogs = append(g.serialLogs, entry)
 	if len(g.serialLogs) > MAX_LOG_ENTRIES {
 		g.serialLogs = g.serialLogs[len(g.serialLogs)-MAX_LOG_ENTRIES:]
@@ -1374,56 +1798,84 @@ func (g *Gateway) handleAPIGatewayLogs(w http.ResponseWriter, r *http.Request) {
 
 // ============== COMMAND POLLING ==============
 
+// COMMAND_POLL_INTERVAL is the fallback poll period when nothing wakes the
+// poller earlier
+const COMMAND_POLL_INTERVAL = 5 * time.Second
+
+// MAX_COMMANDS_PER_POLL caps how many queued commands one poll tick drains
+const MAX_COMMANDS_PER_POLL = 10
+
+// MAX_PENDING_ACKS bounds how many command acks are in flight at once
+const MAX_PENDING_ACKS = 4
+
+// wakeCommandPoller makes commandPoller poll now instead of at its next tick
+func (g *Gateway) wakeCommandPoller() {
+	select {
+	case g.pollWake <- struct{}{}:
+	default: // A wake-up is already pending
+	}
+}
+
 func (g *Gateway) commandPoller() {
-	if g.config.GatewayToken == "" {
-		log.Printf("⚠️ No token, command polling disabled")
-		return
+	if g.gatewayToken() == "" {
+		log.Printf("⚠️ No token, command polling paused until one is set")
 	}
 
-	ticker := time.NewTicker(5 * time.Second)
+	ticker := time.NewTicker(COMMAND_POLL_INTERVAL)
 	defer ticker.Stop()
 
-	g.addGatewayLog("info", "Command polling started (every 5s)")
+	g.addGatewayLog("info", fmt.Sprintf("Command polling started (every %s)", COMMAND_POLL_INTERVAL))
 
-	for g.running {
+	for {
 		select {
+		case <-g.ctx.Done():
+			return
 		case <-ticker.C:
-			g.pollCommands()
+		case <-g.pollWake:
+		}
+
+		// The backend hands out one command per request, so keep polling
+		// while commands are queued instead of waiting a full tick each
+		for i := 0; i < MAX_COMMANDS_PER_POLL; i++ {
+			if !g.pollCommands() {
+				break
+			}
 		}
 	}
 }
 
-func (g *Gateway) pollCommands() {
-	if g.config.GatewayToken == "" {
-		return
+// pollCommands fetches and executes one pending command, reporting whether
+// there was one
+func (g *Gateway) pollCommands() bool {
+	if g.gatewayToken() == "" {
+		return false
 	}
 
-	url := g.config.BackendURL + "/api/v1/commands/pending"
-	req, err := http.NewRequest("GET", url, nil)
+	req, release, err := g.newBackendRequest("GET", "/api/v1/commands/pending", nil)
 	if err != nil {
-		return
+		return false
 	}
-	req.Header.Set("X-Device-Token", g.config.GatewayToken)
+	defer release()
 
-	resp, err := g.httpClient.Do(req)
+	resp, err := g.doBackendRequest(req)
 	if err != nil {
 		g.addGatewayLog("error", "Failed to poll commands: "+err.Error())
-		return
+		return false
 	}
-	defer resp.Body.Close()
+	defer drainAndClose(resp.Body)
 
 	if resp.StatusCode != 200 {
-		return
+		return false
 	}
 
 	var cmd BackendCommand
 	if err := json.NewDecoder(resp.Body).Decode(&cmd); err != nil {
-		return
+		return false
 	}
 
 	// No command or empty response
 	if cmd.ID == "" || cmd.Command == "" {
-		return
+		return false
 	}
 
 	g.addGatewayLog("info", fmt.Sprintf("📥 Received command: %s (ID: %s)", cmd.Command, cmd.ID))
@@ -1433,7 +1885,8 @@ func (g *Gateway) pollCommands() {
 	success := g.executeCommand(cmd)
 
 	// Acknowledge command
-	g.acknowledgeCommand(cmd.ID, success)
+	g.acknowledgeCommandAsync(cmd.ID, success)
+	return true
 }
 
 func (g *Gateway) executeCommand(cmd BackendCommand) bool {
@@ -1492,28 +1945,39 @@ func (g *Gateway) executeCommand(cmd BackendCommand) bool {
 	}
 }
 
+// acknowledgeCommandAsync acks in the background so draining the command
+// queue does not wait an extra round trip per command. The backend marks a
+// command sent when it hands it out, so a late ack cannot cause a re-send.
+func (g *Gateway) acknowledgeCommandAsync(cmdID string, success bool) {
+	g.ackSlots <- struct{}{} // Blocks once MAX_PENDING_ACKS are in flight
+	go func() {
+		defer func() { <-g.ackSlots }()
+		g.acknowledgeCommand(cmdID, success)
+	}()
+}
+
 func (g *Gateway) acknowledgeCommand(cmdID string, success bool) {
 	status := "completed"
 	if !success {
 		status = "failed"
 	}
 
-	url := g.config.BackendURL + "/api/v1/devices/commands/" + cmdID + "/ack"
 	body, _ := json.Marshal(map[string]string{"status": status})
-	
-	req, err := http.NewRequest("POST", url, bytes.NewBuffer(body))
+
+	req, release, err := g.newBackendRequest("POST", "/api/v1/devices/commands/"+cmdID+"/ack", body)
 	if err != nil {
 		return
 	}
-	req.Header.Set("Content-Type", "application/json")
-	req.Header.Set("X-Device-Token", g.config.GatewayToken)
+	defer release()
+	// Acking the same status twice is harmless, so let it be retried
+	req.Header["Idempotency-Key"] = nil
 
-	resp, err := g.httpClient.Do(req)
+	resp, err := g.doBackendRequest(req)
 	if err != nil {
 		g.addGatewayLog("error", "Failed to ack command: "+err.Error())
 		return
 	}
-	defer resp.Body.Close()
+	defer drainAndClose(resp.Body)
 
 	g.addGatewayLog("info", fmt.Sprintf("📤 Command %s acknowledged as %s", cmdID, status))
 }